@@ -27,19 +27,29 @@ SOFTWARE.
 
 import sys
 import argparse
+import atexit
 import logging
 import os
-from typing import List, Optional, Dict
+import queue
+import signal
+import threading
+import time
+from typing import (
+    Any, Callable, FrozenSet, Hashable, List, Optional, Dict, Tuple
+)
 import pickle
-from datetime import datetime
 import requests
+from functools import partial
 from socket import gethostname
-from json import JSONEncoder, dumps
-from collections.abc import MutableMapping
 
+import orjson
+from bson import ObjectId
+from bson.decimal128 import Decimal128
 from pymongo import MongoClient
 from pymongo.errors import PyMongoError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -52,30 +62,49 @@ mongolog.setLevel(logging.WARNING)
 mongolog.propagate = True
 
 
-def flatten(dictionary, parent_key='', separator='_'):
-    # from: https://stackoverflow.com/a/6027615
-    items = []
-    for key, value in dictionary.items():
-        new_key = parent_key + separator + key if parent_key else key
-        if isinstance(value, MutableMapping):
-            items.extend(flatten(value, new_key, separator=separator).items())
-        else:
-            items.append((new_key, value))
-    return dict(items)
-
+def flatten(dictionary: Dict[str, Any], separator: str = '_') -> Dict[str, Any]:
+    # most UniFi log documents are already flat; detect that in one pass
+    # and skip rebuilding the dict entirely
+    for value in dictionary.values():
+        if type(value) is dict:
+            break
+    else:
+        return dictionary
+    out = {}
+    stack = [('', dictionary)]
+    while stack:
+        prefix, cur = stack.pop()
+        for key, value in cur.items():
+            new_key = f'{prefix}{separator}{key}' if prefix else key
+            # exact type check; pymongo decodes subdocuments as plain dicts
+            if type(value) is dict:
+                stack.append((new_key, value))
+            else:
+                out[new_key] = value
+    return out
+
+
+def json_default(o: Any) -> str:
+    # orjson handles datetime natively; this only needs to cover the BSON
+    # types that can show up in UniFi documents
+    if isinstance(o, (ObjectId, Decimal128)):
+        return str(o)
+    raise TypeError(
+        f'Object of type {o.__class__.__name__} is not JSON serializable'
+    )
 
-class MagicEncoder(JSONEncoder):
 
-    def default(self, o):
-        if isinstance(o, datetime):
-            return o.isoformat('T')
-        return super(MagicEncoder, self).default(o)
+#: preconfigured serializer for Mongo-derived dicts, so call sites don't
+#: rebuild the default/option kwargs on every dump
+_dumps: Callable[..., bytes] = partial(
+    orjson.dumps, default=json_default, option=orjson.OPT_NON_STR_KEYS
+)
 
 
 class UnifiToLoki:
 
-    # If adding, be sure to also update UnifiToLoki._labels_for_change()
-    WANTED_COLLECTIONS: List[str] = [
+    # If adding, be sure to also update _ROW_KEY_BUILDERS below
+    WANTED_COLLECTIONS: FrozenSet[str] = frozenset({
         'admin_activity_log',
         'alarm',
         'alert',
@@ -83,10 +112,35 @@ class UnifiToLoki:
         'inspection_log',
         'threat_log_view',
         'trigger_log',
-    ]
+    })
+
+    #: per-collection row_key builders, resolved once at class definition
+    #: so picking one per change is a dict lookup
+    _ROW_KEY_BUILDERS: Dict[str, Callable[[Dict[str, Any]], str]] = {
+        'admin_activity_log': lambda c: c.get('key', 'unknown'),
+        'alarm': lambda c: c.get('key', 'unknown'),
+        'alert': lambda c: c.get('key', 'unknown'),
+        'event': lambda c: c.get('key', 'unknown'),
+        'inspection_log': lambda c: (
+            f"{c.get('log_source', '')}/{c.get('action', '')}"
+        ),
+        'threat_log_view': lambda c: c.get('signature', 'unknown'),
+        'trigger_log': lambda c: c.get('key', 'unknown'),
+    }
 
     RESUME_TOKEN_FILE: str = 'resume_token.pkl'
 
+    #: flush the buffer once it holds this many bytes of values, even if
+    #: the entry-count threshold hasn't been hit yet
+    LOKI_BATCH_MAX_BYTES: int = 1048576
+
+    #: maximum seconds a buffered change waits before being flushed to Loki
+    LOKI_BATCH_MAX_DELAY: float = 0.5
+
+    #: minimum seconds between resume token writes; the token only needs to
+    #: be durable enough to bound replay after a restart
+    RESUME_TOKEN_MIN_INTERVAL: float = 1.0
+
     def __init__(self):
         if 'MONGODB_CONN_STR' not in os.environ:
             raise RuntimeError(
@@ -101,92 +155,268 @@ class UnifiToLoki:
         self.resume_token: Optional[Dict] = None
         if os.path.exists(self.RESUME_TOKEN_FILE):
             with open(self.RESUME_TOKEN_FILE, 'rb') as fh:
-                self.resume_token = pickle.load(fh)
+                raw = fh.read()
+            try:
+                self.resume_token = orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                # token written by an older version in pickle format; it
+                # will be re-written as JSON on the next flush
+                self.resume_token = pickle.loads(raw)
         self.host: str
         if 'LOG_HOST' in os.environ:
             self.host = os.environ['LOG_HOST']
         else:
             self.host = gethostname()
+        # keep-alive session so every POST to Loki doesn't pay TCP/HTTP
+        # connection setup
+        self._session: requests.Session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=10,
+            max_retries=Retry(
+                total=3, backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+                # urllib3 doesn't retry POST by default; our pushes are safe
+                # to retry since delivery is at-least-once anyway
+                allowed_methods=None
+            )
+        )
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._headers: Dict[str, str] = {'Content-type': 'application/json'}
+        # everything but row_key is constant per collection for the lifetime
+        # of the process, so prebuild one label template per collection and
+        # copy it per change instead of constructing a fresh dict literal
+        self._label_templates: Dict[str, Dict[str, str]] = {
+            c: {
+                'source': 'unifi-mongodb-watcher',
+                'job': 'unifi-mongodb-watcher',
+                'host': self.host,
+                'collection': c,
+            }
+            for c in self.WANTED_COLLECTIONS
+        }
+        self._batch_size: int = int(os.environ.get('LOKI_BATCH_SIZE', '100'))
+        # opt-in: emit each stream's flat-dict keys once per batch and the
+        # values positionally, instead of repeating the keys in every line;
+        # requires a consumer that understands the __keys__/__vals__ format
+        self._key_header: bool = os.environ.get(
+            'LOKI_KEY_HEADER', 'false'
+        ).lower() in ('1', 'true', 'yes')
+        # buffered changes awaiting a push to Loki, keyed by labelset (plus
+        # key schema if LOKI_KEY_HEADER is on); each entry is a pre-encoded
+        # ["<ts>","<line>"] JSON fragment
+        self._buffer: Dict[Hashable, List[bytes]] = {}
+        self._buffer_count: int = 0
+        self._buffer_bytes: int = 0
+        self._buffer_deadline: float = 0.0
+        # POSTs to Loki run on this thread so the next getMore from
+        # MongoDB overlaps with serialization and network time; the
+        # bounded queue provides backpressure if Loki falls behind
+        self._post_queue: queue.Queue = queue.Queue(maxsize=8)
+        self._poster: threading.Thread = threading.Thread(
+            target=self._post_worker, name='loki-poster', daemon=True
+        )
+        self._post_error: Optional[BaseException] = None
+        #: resume token of the last batch Loki acknowledged; only this is
+        #: ever persisted, so a crash replays un-acked changes
+        self._acked_token: Optional[Dict] = None
+        self._written_token: Optional[Dict] = None
+        self._token_written_at: float = 0.0
+        atexit.register(self._write_resume_token, force=True)
 
     def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
         logger.info('connecting to mongodb at: %s', self.mongo_conn_str)
         client: MongoClient = MongoClient(self.mongo_conn_str)
         logger.info('selecting DB: unifi')
         db = client.unifi
+        self._poster.start()
         try:
+            # filter uninteresting collections server-side so MongoDB never
+            # ships their events to us at all; this is also why we don't use
+            # RawBSONDocument to lazily skip decoding unwanted events — every
+            # event that reaches us gets fully handled, so the raw codec
+            # would only add a second decode on the hot path
             with db.watch(
-                [{"$match": {"operationType": "insert"}}],
-                resume_after=self.resume_token
+                [{"$match": {
+                    "operationType": "insert",
+                    "ns.coll": {"$in": sorted(self.WANTED_COLLECTIONS)},
+                }}],
+                resume_after=self.resume_token,
+                batch_size=int(os.environ.get('CHANGE_BATCH_SIZE', '500')),
+                max_await_time_ms=int(
+                    os.environ.get('CHANGE_MAX_AWAIT_MS', '500')
+                ),
+                full_document='updateLookup'
             ) as stream:
                 logger.info('waiting for changes...')
-                change: Dict
-                for change in stream:
-                    coll = change.get('ns', {}).get('coll')
-                    if coll in self.WANTED_COLLECTIONS:
-                        self.handle_change(change)
-                    else:
-                        logger.debug('Ignoring change for collection: %s', coll)
-                    self.resume_token = change['_id']
-                    with open(self.RESUME_TOKEN_FILE, 'wb') as fh:
-                        pickle.dump(self.resume_token, fh, pickle.HIGHEST_PROTOCOL)
-                        logger.debug('Wrote %s', self.RESUME_TOKEN_FILE)
+                # bind hot attributes to locals; LOAD_FAST beats
+                # LOAD_ATTR/LOAD_GLOBAL in a loop that runs once per change
+                try_next = stream.try_next
+                handle = self.handle_change
+                flush = self._flush
+                write_token = self._write_resume_token
+                monotonic = time.monotonic
+                wanted = self.WANTED_COLLECTIONS
+                change: Optional[Dict]
+                while stream.alive:
+                    if self._post_error is not None:
+                        raise self._post_error
+                    change = try_next()
+                    if change is not None:
+                        # the pipeline already filtered on ns.coll
+                        assert change['ns']['coll'] in wanted
+                        handle(change)
+                        self.resume_token = change['_id']
+                    if self._buffer and monotonic() > self._buffer_deadline:
+                        flush()
+                    write_token()
         except PyMongoError as ex:
             print(f'PyMongoError: {ex}')
             raise
-
-    def _labels_for_change(self, change: Dict) -> dict:
-        result = {
-            'source': 'unifi-mongodb-watcher',
-            'job': 'unifi-mongodb-watcher',
-            'host': self.host,
-            'collection': change['collection'],
-        }
-        if change['collection'] == 'admin_activity_log':
-            result['row_key'] = change.get('key', 'unknown')
-        elif change['collection'] == 'alarm':
-            result['row_key'] = change.get('key', 'unknown')
-        elif change['collection'] == 'alert':
-            result['row_key'] = change.get('key', 'unknown')
-        elif change['collection'] == 'event':
-            result['row_key'] = change.get('key', 'unknown')
-        elif change['collection'] == 'inspection_log':
-            result['row_key'] = change.get('log_source', '') + '/' + change.get('action', '')
-        elif change['collection'] == 'threat_log_view':
-            result['row_key'] = change.get('signature', 'unknown')
-        elif change['collection'] == 'trigger_log':
-            result['row_key'] = change.get('key', 'unknown')
-        return result
-
-    def handle_change(self, change: Dict):
-        change['fullDocument']['collection'] = change['ns']['coll']
-        change = change['fullDocument']
-        logger.debug('Handle change: %s', change)
-        change['_id'] = str(change['_id'])
-        if len(str(change['time'])) > 10:
-            change['time'] = change['time'] / 1000
-        ts = str(int(change['time']) * 1000000000)
-        logger.debug(change)
-        flat: dict = flatten(change)
-        payload = {
-            'streams': [
-                {
-                    'stream': self._labels_for_change(change),
-                    'values': [
-                        [ts, dumps(flat, cls=MagicEncoder)]
-                    ],
-                }
-            ]
-        }
-        j = dumps(payload, cls=MagicEncoder)
-        logger.debug('POST to: %s', self.loki_url)
-        resp = requests.post(self.loki_url, data=j, headers={'Content-type': 'application/json'})
+        finally:
+            self._flush()
+            try:
+                self._post_queue.put(None, timeout=5)
+            except queue.Full:
+                pass
+            self._poster.join(timeout=30)
+            self._write_resume_token(force=True)
+
+    def _write_resume_token(self, force: bool = False):
+        """
+        Persist the last Loki-acknowledged resume token, if it changed. Writes
+        are rate-limited to one per RESUME_TOKEN_MIN_INTERVAL seconds unless
+        ``force`` is set, and are atomic (written to a temp file and renamed
+        into place) so a crash mid-write can't corrupt the token.
+        """
+        token = self._acked_token
+        if token is None or token == self._written_token:
+            return
+        now = time.monotonic()
+        if not force and now - self._token_written_at < self.RESUME_TOKEN_MIN_INTERVAL:
+            return
+        tmp = self.RESUME_TOKEN_FILE + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(orjson.dumps(token))
+        os.replace(tmp, self.RESUME_TOKEN_FILE)
+        self._written_token = token
+        self._token_written_at = now
+        logger.debug('Wrote %s', self.RESUME_TOKEN_FILE)
+
+    def _handle_signal(self, signum, frame):
+        logger.warning('Received signal %d; shutting down', signum)
+        raise SystemExit(0)
+
+    def _labels_for_change(self, change: Dict[str, Any]) -> Dict[str, str]:
+        coll = change['collection']
+        labels = self._label_templates[coll].copy()
+        labels['row_key'] = self._ROW_KEY_BUILDERS[coll](change)
+        return labels
+
+    def _prepare(
+        self, change: Dict[str, Any]
+    ) -> Tuple[Dict[str, str], Dict[str, Any], bytes]:
+        """
+        Build the Loki labels, flattened document, and nanosecond timestamp
+        for one change stream event, without mutating the event itself.
+        """
+        doc = dict(change['fullDocument'])
+        doc['collection'] = change['ns']['coll']
+        doc['_id'] = str(doc['_id'])
+        t = doc['time']
+        if t >= 10_000_000_000:
+            # value too large to be seconds since epoch; must be milliseconds
+            t = doc['time'] = t / 1000
+        ts: bytes = b'%d' % (int(t) * 1_000_000_000)
+        # serializing the document for the log line isn't free; only do it
+        # when debug logging is actually on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Handle change: %s', _dumps(doc).decode())
+        return self._labels_for_change(doc), flatten(doc), ts
+
+    def handle_change(self, change: Dict[str, Any]):
+        labels, flat, ts = self._prepare(change)
+        labelset = frozenset(labels.items())
+        key: Hashable
+        if self._key_header:
+            # group by (labels, key schema) so every line in a stream shares
+            # the key header carried by the stream's first entry
+            key = (labelset, tuple(flat))
+            if key in self._buffer:
+                doc = {'__vals__': list(flat.values())}
+            else:
+                doc = {'__keys__': list(flat), '__vals__': list(flat.values())}
+        else:
+            key = labelset
+            doc = flat
+        line: str = _dumps(doc).decode()
+        # encode the ["<ts>","<line>"] pair once here, so the flush can
+        # assemble the envelope by concatenation instead of re-walking
+        # every buffered line through a second full JSON encode
+        entry: bytes = (
+            b'["' + ts + b'",' + orjson.dumps(line) + b']'
+        )
+        if not self._buffer:
+            self._buffer_deadline = time.monotonic() + self.LOKI_BATCH_MAX_DELAY
+        self._buffer.setdefault(key, []).append(entry)
+        self._buffer_count += 1
+        self._buffer_bytes += len(entry)
+        if (
+            self._buffer_count >= self._batch_size
+            or self._buffer_bytes >= self.LOKI_BATCH_MAX_BYTES
+        ):
+            self._flush()
+
+    def _flush(self):
+        """Serialize buffered changes and queue them for POSTing to Loki."""
+        if not self._buffer:
+            return
+        j: bytes = b'{"streams":[' + b','.join(
+            b'{"stream":'
+            + _dumps(dict(k[0] if self._key_header else k))
+            + b',"values":[' + b','.join(v) + b']}'
+            for k, v in self._buffer.items()
+        ) + b']}'
+        count = self._buffer_count
+        self._buffer = {}
+        self._buffer_count = 0
+        self._buffer_bytes = 0
+        # self.resume_token doesn't yet include any change still being
+        # handled, so acking this token can never skip a buffered change
+        self._post_queue.put((j, self.resume_token, count))
+
+    def _post_worker(self):
+        """Loki POST loop; runs on the ``loki-poster`` thread."""
+        while True:
+            item = self._post_queue.get()
+            if item is None:
+                return
+            # after a POST failure, keep draining (and discarding) items so
+            # a full queue can never block the main thread's put(); run()
+            # re-raises the recorded error and the discarded changes are
+            # replayed from the last acked resume token on restart
+            if self._post_error is not None:
+                continue
+            body, token, count = item
+            try:
+                self._post_batch(body, count)
+                self._acked_token = token
+            except Exception as ex:
+                self._post_error = ex
+
+    def _post_batch(self, body: bytes, count: int):
+        logger.debug('POST %d values to: %s', count, self.loki_url)
+        resp = self._session.post(
+            self.loki_url, data=body, headers=self._headers, timeout=(3, 10)
+        )
         logger.debug('Loki responded HTTP %d: %s', resp.status_code, resp.text)
         try:
             resp.raise_for_status()
         except requests.exceptions.HTTPError:
             logger.error(
                 'POST to %s returned HTTP %d: %s\nwith payload: %s',
-                self.loki_url, resp.status_code, resp.text, payload
+                self.loki_url, resp.status_code, resp.text, body.decode()
             )
             raise
 